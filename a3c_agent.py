@@ -3,13 +3,17 @@
 """
 
 import os
+import json
 import time
+import queue
+import heapq
 import pickle
 import threading
+import collections
 import tensorflow as tf
 import tensorflow.contrib.layers as layers
 import numpy as np
-from xml.dom import minidom
+from scipy.signal import lfilter
 from xml.etree import ElementTree as ET
 from pysc2.lib import actions
 from pysc2.lib import features
@@ -18,6 +22,7 @@ import constants
 
 A3C_SCREEN_SIZE_X = 32
 A3C_SCREEN_SIZE_Y = 32
+UNIT_TYPE_EMBEDDING_SIZE = 8
 
 TRAINING = True
 DISCOUNT_FACTOR = 0.99
@@ -27,14 +32,62 @@ EPSILON = 0.05
 
 NUM_BATCHES = 20
 PARALLEL_THREADS = 16
+PREDICTORS = 2  # number of predictor threads
+PREDICTION_BATCH_SIZE = PARALLEL_THREADS  # maximum number of states in one forward pass
+PREDICTION_WAIT = 0.001  # seconds a predictor thread waits for more states before running a forward pass
 MAX_STEPS_TOTAL = 10 * 10**6
 # MAX_STEPS_TOTAL = 100000
 CHECKPOINT = 500
 SAVE_PATH = './saved_checkpoints/'
 LOG_PATH = './logs/'
 PLOT_PATH = './plots/'
+MAX_EPISODE_STEPS = 1024  # number of steps the replay buffers hold, for longer episodes only the most recent ones are kept
 DETAILED_LOGS = 10  # detailed logs are kept for top 10 episodes and last 10 episodes
 SHOW_PROGRESS = True
+DEVICE = '/gpu:0'  # device of the neural network and its training
+OBSERVATIONS = ('screen', 'player', 'available_actions', 'score_cumulative')  # observations used by the agent
+# attributes of the actions in the detailed logs
+ACTION_LOG_ATTRIBUTES = ('name', 'x', 'y', 'random_action', 'random_position', 'collected_minerals', 'collected_gas')
+
+
+def indent_xml(element, level=0):
+    """Indents an XML element and all its children in place, for pretty printing the XML logs.
+
+    :param element: the XML element to indent
+    :param level: the depth of the element in the XML tree
+    """
+    indent = '\n' + level * '  '
+    if len(element):
+        if not element.text or not element.text.strip():
+            element.text = indent + '  '
+        for child in element:
+            indent_xml(child, level + 1)
+        if not child.tail or not child.tail.strip():
+            child.tail = indent
+    if level and (not element.tail or not element.tail.strip()):
+        element.tail = indent
+
+
+def append_actions(episode, columns):
+    """Appends the XML elements of the performed actions to the XML element of an episode.
+
+    :param episode: the XML element of the episode
+    :param columns: a dictionary with one array per attribute of the actions, the names are stored as action ids
+    """
+    names = [actions.FUNCTIONS[action_id].name for action_id in columns['name'].tolist()]
+    # each attribute is formatted for all actions at once
+    values = []
+    for k in ACTION_LOG_ATTRIBUTES[1:]:
+        if columns[k].dtype == bool:
+            values.append(np.where(columns[k], 'True', 'False').tolist())
+        else:
+            values.append(np.char.mod('%d', columns[k]).tolist())
+
+    for name, *action_values in zip(names, *values):
+        performed_action = ET.SubElement(episode, 'action')
+        performed_action.attrib['name'] = name
+        for k, v in zip(ACTION_LOG_ATTRIBUTES[1:], action_values):
+            performed_action.attrib[k] = v
 
 
 class NeuralNetwork:
@@ -46,20 +99,36 @@ class NeuralNetwork:
     fully connected neural network for selecting the non-spatial action and another fully connected neural network that
     gives the value of a given state.
 
+    The unit types on the screen are categorical, they are fed as ids and mapped to a learned embedding, which is
+    concatenated with the other screen features. The screen inputs are fed as small integer types (the unit type ids
+    as uint16, the other screen layers as uint8) and converted in the graph.
+
     Based on https://github.com/xhujoy/pysc2-agents
     """
-    def __init__(self, num_screen_features, num_extra_features, num_actions):
-        """Builds the neural network."""
-        self.screen = tf.placeholder(shape=(None, num_screen_features, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y), dtype=np.float32, name='screen')
-        self.non_spatial_features = tf.placeholder(shape=(None, num_extra_features), dtype=np.float32, name='non_spatial_features')
+    def __init__(self, num_unit_types, screen_scales, num_extra_features, num_actions, inputs):
+        """Builds the neural network.
 
-        screen_conv1 = layers.conv2d(tf.transpose(self.screen, [0, 2, 3, 1]), num_outputs=16, kernel_size=5, stride=1,scope='screen_conv1')
+        :param screen_scales: the scaling factors of the screen layers, they are fed unscaled and scaled in the graph
+        :param inputs: the default inputs (unit types, screen, non spatial features), which are used if the inputs
+            aren't fed
+        """
+        num_screen_features = len(screen_scales)
+        self.unit_type = tf.placeholder_with_default(inputs[0], shape=(None, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y), name='unit_type')
+        self.screen = tf.placeholder_with_default(inputs[1], shape=(None, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, num_screen_features), name='screen')
+        self.non_spatial_features = tf.placeholder_with_default(inputs[2], shape=(None, num_extra_features), name='non_spatial_features')
+        self.inputs = [self.unit_type, self.screen, self.non_spatial_features]
+
+        unit_type_embedding = tf.get_variable('unit_type_embedding', shape=(num_unit_types, UNIT_TYPE_EMBEDDING_SIZE), dtype=tf.float32)
+        screen_scale = tf.constant(1 / np.array(screen_scales, dtype=np.float32).reshape((1, 1, 1, num_screen_features)))
+        unit_type_features = tf.nn.embedding_lookup(unit_type_embedding, tf.cast(self.unit_type, tf.int32))
+        screen_features = tf.concat([unit_type_features, tf.cast(self.screen, tf.float32) * screen_scale], axis=3)
+
+        screen_conv1 = layers.conv2d(screen_features, num_outputs=16, kernel_size=5, stride=1, data_format='NHWC', scope='screen_conv1')
         screen_conv2 = layers.conv2d(screen_conv1, num_outputs=32, kernel_size=3, stride=1, scope='screen_conv2')
 
-        non_spatial_features = layers.fully_connected(layers.flatten(self.non_spatial_features), num_outputs=256, activation_fn=tf.tanh, scope='non_spatial_features')
+        non_spatial_features = layers.fully_connected(self.non_spatial_features, num_outputs=256, activation_fn=tf.tanh, scope='non_spatial_features')
 
-        features_convoluted = tf.concat([screen_conv2], axis=3)
-        spatial_action = layers.conv2d(features_convoluted, num_outputs=1, kernel_size=1, stride=1, activation_fn=None, scope='spatial_action')
+        spatial_action = layers.conv2d(screen_conv2, num_outputs=1, kernel_size=1, stride=1, activation_fn=None, scope='spatial_action')
 
         full_features = tf.concat([layers.flatten(screen_conv2), non_spatial_features], axis=1)
         full_features = layers.fully_connected(full_features, num_outputs=256, activation_fn=tf.nn.relu, scope='full_features')
@@ -69,6 +138,73 @@ class NeuralNetwork:
         self.value = tf.reshape(layers.fully_connected(full_features, num_outputs=1, activation_fn=None, scope='value'), [-1])
 
 
+class Predictor:
+    """Batched inference for all agent instances.
+
+    Instead of every agent instance running its own forward pass, the agents put their inputs into a shared queue.
+    PREDICTORS predictor threads collect the pending requests (at most PREDICTION_BATCH_SIZE, waiting at most
+    PREDICTION_WAIT seconds for more requests after the first one), stack them into one batch and run the neural
+    network once for the whole batch. The results are handed back to the waiting agents. With more than one predictor
+    thread the next batch can be collected while the previous one is still running.
+    """
+    def __init__(self, session, nn):
+        """Initialises the predictor and starts its threads.
+
+        :param session: the TensorFlow session to which the agent instances belong
+        :param nn: the neural network used for the forward pass, the weights are shared by all agent instances
+        """
+        self.tf_session = session
+        self.nn = nn
+        self.pending = queue.Queue()
+        # the forward pass takes the stacked inputs of a batch in the order of the inputs of the neural network
+        self.forward = session.make_callable([nn.non_spatial_action, nn.spatial_action, nn.value], nn.inputs)
+
+        for _ in range(PREDICTORS):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+
+    def predict(self, state):
+        """Runs the forward pass for one state, blocks until a predictor thread processed it.
+
+        :param state: the inputs of the neural network for one state (without the batch dimension), in the order of
+            the inputs of the neural network
+        :return: the output of the non spatial action, of the spatial action and the value (with a batch dimension of
+            one)
+        """
+        reply_event = threading.Event()
+        slot = []
+        self.pending.put((state, reply_event, slot))
+        reply_event.wait()
+        if isinstance(slot[0], Exception):
+            raise slot[0]
+        return slot
+
+    def run(self):
+        """Main loop of the predictor thread."""
+        while True:
+            requests = [self.pending.get()]
+            deadline = time.time() + PREDICTION_WAIT
+            while len(requests) < PREDICTION_BATCH_SIZE:
+                try:
+                    requests.append(self.pending.get(timeout=max(0, deadline - time.time())))
+                except queue.Empty:
+                    break
+
+            states = [request[0] for request in requests]
+            try:
+                outputs = self.forward(*[np.stack(values) for values in zip(*states)])
+            except Exception as error:
+                # hand the error over to the waiting agents, otherwise they would wait forever
+                outputs = error
+
+            for i, (_, reply_event, slot) in enumerate(requests):
+                if isinstance(outputs, Exception):
+                    slot.append(outputs)
+                else:
+                    slot.extend(output[i:i + 1] for output in outputs)
+                reply_event.set()
+
+
 class A3CAgent:
     """An agent for collecting resources using the asynchronous advantage actor-critic algorithm.
 
@@ -80,6 +216,12 @@ class A3CAgent:
     Based on https://github.com/xhujoy/pysc2-agents
     """
     action_logs = {}
+    # actions of the kept episodes as one array per attribute, their XML elements are only created when the logs are
+    # written
+    pending_action_logs = {}
+    predictor = None
+    # one saver for the variables of all agent instances, created by main once all of them are in the graph
+    saver = None
 
     STEP_COUNTER = 0
     EPISODE_COUNTER = 0
@@ -104,11 +246,14 @@ class A3CAgent:
 
         self.agent_id = agent_id
         A3CAgent.action_logs[self.agent_id] = None
+        A3CAgent.pending_action_logs[self.agent_id] = {}
         reuse = self.agent_id > 0
 
         self.epsilon = EPSILON
         self.exploration_rate = EXPLORATION_RATE
         self.discount_factor = DISCOUNT_FACTOR
+        # every agent instance has its own random generator, the global one of NumPy is shared by all threads
+        self.rng = np.random.default_rng(agent_id)
 
         self.executable_actions_ids = [
             actions.FUNCTIONS.no_op.id,
@@ -126,9 +271,24 @@ class A3CAgent:
             actions.FUNCTIONS.Rally_Workers_screen.id,
         ]
 
+        # maps the id of an action to its index in executable_actions_ids, -1 for all other actions
+        self.action_idx = np.full(max(self.executable_actions_ids) + 1, -1, dtype=np.int32)
+        self.action_idx[self.executable_actions_ids] = np.arange(len(self.executable_actions_ids))
+
+        # whether an action needs a target on the screen and the arguments of each action, None marks the screen target
+        # (note that select_rect is not supported yet), all other arguments are only executing direct actions, no queuing
+        self.has_screen_arg = np.zeros(len(self.action_idx), dtype=bool)
+        self.arg_templates = {}
+        for action_id in self.executable_actions_ids:
+            self.arg_templates[action_id] = [None if arg.name == 'screen' else [0] for arg in actions.FUNCTIONS[action_id].args]
+            self.has_screen_arg[action_id] = None in self.arg_templates[action_id]
+
+        # The unit type has different values for everything in the minigame, it is fed as id into an embedding
+        self.unit_type_layer = features.SCREEN_FEATURES.unit_type.index
+        num_unit_types = features.SCREEN_FEATURES.unit_type.scale
+
         # Second number is the scaling factor
         self.screen_features_layers = [
-            (features.SCREEN_FEATURES.unit_type.index, 342),  # This has different values for everything in the minigame
             (features.SCREEN_FEATURES.selected.index, 2)
         ]
 
@@ -139,27 +299,88 @@ class A3CAgent:
             constants.Player_idle_worker_count,
         ]
 
-        self.replay_states = []
-        self.replay_actions = []
+        self.num_replay_states = 0
+
+        # min-heaps of (value, episode) with the top episodes for collected minerals and gas, together with the most
+        # recent episodes these are the episodes for which the detailed action logs are kept
+        self.top_minerals = []
+        self.top_gas = []
+        self.recent_episodes = collections.deque(maxlen=DETAILED_LOGS)
+        self.kept_episodes = set()
+        # the XML elements of the kept episodes, by the number of the episode of this agent instance
+        self.episode_elements = {}
+        self.episode_log = None
 
-        self.summary = []
+        self.scalar_summaries = []
+        self.hist_summaries = []
         self.summary_writer = summary_writer
 
         num_actions = len(self.executable_actions_ids)
         num_screen_features = len(self.screen_features_layers)
         num_non_spatial_features = len(self.player_feature_indexes) + num_actions  # We append available actions
 
-        with tf.variable_scope(name):
+        # buffer used by step() for selecting the best valid action
+        self.action_scores = np.empty(num_actions, dtype=np.float32)
+
+        # the replay states of an episode, one array per field, they are used as ring buffers of a fixed size, the rows
+        # of the current episode are given by replay_rows()
+        self.replay_unit_types = np.empty((MAX_EPISODE_STEPS, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y), dtype=np.uint16)
+        self.replay_screens = np.empty((MAX_EPISODE_STEPS, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, num_screen_features), dtype=np.uint8)
+        self.replay_non_spatial_features = np.empty((MAX_EPISODE_STEPS, num_non_spatial_features), dtype=np.float32)
+        self.replay_rewards = np.empty(MAX_EPISODE_STEPS, dtype=np.float32)
+        self.replay_values = np.empty(MAX_EPISODE_STEPS, dtype=np.float32)
+        self.replay_minerals = np.empty(MAX_EPISODE_STEPS, dtype=np.int32)
+        self.replay_gas = np.empty(MAX_EPISODE_STEPS, dtype=np.int32)
+        self.replay_last = np.empty(MAX_EPISODE_STEPS, dtype=bool)
+        self.replay_action_ids = np.empty(MAX_EPISODE_STEPS, dtype=np.int32)
+        self.replay_action_targets = np.empty((MAX_EPISODE_STEPS, 2), dtype=np.int32)
+        self.replay_valid_actions = np.empty((MAX_EPISODE_STEPS, num_actions), dtype=bool)
+        self.replay_random_actions = np.empty(MAX_EPISODE_STEPS, dtype=bool)
+        self.replay_random_positions = np.empty(MAX_EPISODE_STEPS, dtype=bool)
+
+        # the shared weights, the rollout buffers and the training are placed on the GPU (the session falls back to the CPU
+        # if there is none), the ops without a GPU kernel, like the summaries, are placed on the CPU automatically
+        with tf.device(DEVICE), tf.variable_scope(name):
             if reuse:
                 tf.get_variable_scope().reuse_variables()
 
-            self.nn = NeuralNetwork(num_screen_features, num_non_spatial_features, num_actions)
-
-            self.has_spatial_action = tf.placeholder(tf.float32, [None, ], name='has_spatial_action')
-            self.valid_non_spatial_actions = tf.placeholder(tf.float32, [None, num_actions], name='valid_non_spatial_actions')
-            self.spatial_action_selected = tf.placeholder(tf.float32, [None, A3C_SCREEN_SIZE_X * A3C_SCREEN_SIZE_Y], name='spatial_action_selected')
-            self.non_spatial_action_selected = tf.placeholder(tf.float32, [None, num_actions], name='non_spatial_action_selected')
-            self.R = tf.placeholder(tf.float32, [None], name='R')
+            # The rollout of an episode is copied once into buffers on the device, the training batches are sliced from
+            # these buffers, so only the index of the batch has to be fed for each training step. The selected actions
+            # are copied as indices (-1 for actions without a position on the screen) and one-hot encoded on the device.
+            rollout_shapes = [
+                ('unit_type', [A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y], tf.uint16),
+                ('screen', [A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, num_screen_features], tf.uint8),
+                ('non_spatial_features', [num_non_spatial_features], tf.float32),
+                ('R', [], tf.float32),
+                ('spatial_action', [], tf.int32),
+                ('valid_non_spatial_actions', [num_actions], tf.bool),
+                ('non_spatial_action', [], tf.int32),
+            ]
+            self.rollout = {}
+            self.batch_index = tf.placeholder(tf.int32, [], name='batch_index')
+            batch = {}
+            upload_ops = []
+            for input_name, shape, dtype in rollout_shapes:
+                self.rollout[input_name] = tf.placeholder(dtype, [None] + shape, name='rollout_' + input_name)
+                rollout_buffer = tf.Variable(tf.zeros([0] + shape, dtype=dtype), trainable=False, validate_shape=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='rollout_buffer_' + input_name)
+                upload_ops.append(tf.assign(rollout_buffer, self.rollout[input_name], validate_shape=False))
+
+                # the rollout is stored from the first state to the last one, the batches start with the last states,
+                # this is the same split as np.array_split(rollout[::-1], NUM_BATCHES)[batch_index], up to the order of
+                # the batch sizes and of the states within a batch
+                rollout_size = tf.shape(rollout_buffer)[0]
+                batch[input_name] = rollout_buffer[rollout_size - (self.batch_index + 1) * rollout_size // NUM_BATCHES:rollout_size - self.batch_index * rollout_size // NUM_BATCHES]
+                batch[input_name].set_shape([None] + shape)
+            self.upload_rollout = tf.group(*upload_ops)
+
+            screen_scales = [x[1] for x in self.screen_features_layers]
+            self.nn = NeuralNetwork(num_unit_types, screen_scales, num_non_spatial_features, num_actions, inputs=(batch['unit_type'], batch['screen'], batch['non_spatial_features']))
+
+            self.has_spatial_action = tf.placeholder_with_default(tf.cast(batch['spatial_action'] >= 0, tf.float32), [None, ], name='has_spatial_action')
+            self.valid_non_spatial_actions = tf.placeholder_with_default(tf.cast(batch['valid_non_spatial_actions'], tf.float32), [None, num_actions], name='valid_non_spatial_actions')
+            self.spatial_action_selected = tf.placeholder_with_default(tf.one_hot(batch['spatial_action'], A3C_SCREEN_SIZE_X * A3C_SCREEN_SIZE_Y), [None, A3C_SCREEN_SIZE_X * A3C_SCREEN_SIZE_Y], name='spatial_action_selected')
+            self.non_spatial_action_selected = tf.placeholder_with_default(tf.one_hot(batch['non_spatial_action'], num_actions), [None, num_actions], name='non_spatial_action_selected')
+            self.R = tf.placeholder_with_default(batch['R'], [None], name='R')
 
             spatial_action_prob = tf.reduce_sum(tf.multiply(self.nn.spatial_action, self.spatial_action_selected), axis=1) # axis=1?
             spatial_action_log_prob = tf.log(tf.clip_by_value(spatial_action_prob, 1e-10, 1))  # MANNSI: Not possible to renormalize here because we don't know which spatial actions are legal.
@@ -170,8 +391,8 @@ class A3CAgent:
             non_spatial_action_prob = tf.div(non_spatial_action_prob, valid_non_spatial_action_prob)  # MANNSI: Div here is done to renormalize based on legal non_spatial actions.
             non_spatial_action_log_prob = tf.log(tf.clip_by_value(non_spatial_action_prob, 1e-10, 1))
 
-            self.summary.append(tf.summary.histogram('spatial_action_prob', spatial_action_prob))
-            self.summary.append(tf.summary.histogram('non_spatial_action_prob', non_spatial_action_prob))
+            self.hist_summaries.append(tf.summary.histogram('spatial_action_prob', spatial_action_prob))
+            self.hist_summaries.append(tf.summary.histogram('non_spatial_action_prob', non_spatial_action_prob))
 
             action_log_prob = tf.add(tf.multiply(self.has_spatial_action, spatial_action_log_prob), non_spatial_action_log_prob)
             advantage = tf.stop_gradient(tf.subtract(self.R, self.nn.value))
@@ -182,24 +403,32 @@ class A3CAgent:
 
             loss = tf.add(self.policy_loss, self.value_loss)
 
-            self.summary.append(tf.summary.scalar('policy_loss', self.policy_loss))
-            self.summary.append(tf.summary.scalar('value_loss', self.value_loss))
+            self.scalar_summaries.append(tf.summary.scalar('policy_loss', self.policy_loss))
+            self.scalar_summaries.append(tf.summary.scalar('value_loss', self.value_loss))
 
             self.learning_rate = tf.placeholder(tf.float32, None, name='learning_rate')
-            optimizer = tf.train.RMSPropOptimizer(self.learning_rate, decay=0.99, epsilon=1e-10, use_locking=True)
+            # the agent instances share the weights and update them without locking (Hogwild!), like in the A3C paper
+            optimizer = tf.train.RMSPropOptimizer(self.learning_rate, decay=0.99, epsilon=1e-10, use_locking=False)
             gradients = optimizer.compute_gradients(loss)
             clipped_gradients = []
             for grad, var in gradients:
                 grad = tf.clip_by_norm(grad, 100.0) # if gradients get updated more frequently, it probably should be 10
                 clipped_gradients.append([grad, var])
 
-                self.summary.append(tf.summary.histogram(var.op.name, var))
-                self.summary.append(tf.summary.histogram(var.op.name + '/grad', grad))
+                self.hist_summaries.append(tf.summary.histogram(var.op.name, var))
+                self.hist_summaries.append(tf.summary.histogram(var.op.name + '/grad', grad))
             self.train = optimizer.apply_gradients(clipped_gradients)
-            self.summary_op = tf.summary.merge(self.summary)
+            self.summary_op_scalar = tf.summary.merge(self.scalar_summaries)
+            self.summary_op_hist = tf.summary.merge(self.hist_summaries)
 
         self.tf_session = session
-        self.saver = tf.train.Saver()
+
+        # the training step only needs the index of the batch and the learning rate, the batch itself is read from the
+        # rollout buffer in the graph
+        self.train_step = session.make_callable([self.train, self.policy_loss, self.value_loss], [self.batch_index, self.learning_rate], accept_options=True)
+
+        if not reuse:
+            A3CAgent.predictor = Predictor(session, self.nn)
 
     def setup(self, obs_spec, action_spec):
         """Setup method, called by the environment when starting the agent."""
@@ -220,7 +449,7 @@ class A3CAgent:
             self.steps = 0
             return
 
-        if len(self.replay_states) > 0:
+        if self.num_replay_states > 0:
             self.episodes += 1
             self.steps = 0
             with A3CAgent.LOCK:
@@ -228,18 +457,17 @@ class A3CAgent:
                 global_episode = A3CAgent.EPISODE_COUNTER
                 global_steps = A3CAgent.STEP_COUNTER
 
-            reward, policy_loss, value_loss = self.update()
+            reward, policy_loss, value_loss = self.update(write_histograms=global_episode % CHECKPOINT == 0)
 
             self.save_action_log(global_episode, reward, policy_loss, value_loss)
-            self.replay_states = []
-            self.replay_actions = []
+            self.num_replay_states = 0
 
             if SHOW_PROGRESS:
                 print(f'Episode {global_episode} finished, took: {time.time()- self.episode_start:4.3f}. Rew:{reward} seconds')
             self.episode_start = time.time()
 
             if global_episode % CHECKPOINT == 0:
-                print('Episode: {0:d}, step {1:d}/{2:d}, saving model...'.format(global_episode, global_steps, MAX_STEPS_TOTAL))
+                print(f'Episode: {global_episode:d}, step {global_steps:d}/{MAX_STEPS_TOTAL:d}, saving model...')
                 self.save_checkpoint(global_steps, global_episode)
                 print('Model saved')
         else:
@@ -264,17 +492,18 @@ class A3CAgent:
             # stopping the execution of the threads via an exception
             raise KeyboardInterrupt
 
-        nn_input = self.create_feed_dict(obs.observation)
-        non_spatial_action, spatial_action = self.tf_session.run([self.nn.non_spatial_action, self.nn.spatial_action], feed_dict=nn_input)
+        i = self.num_replay_states % MAX_EPISODE_STEPS
+
+        valid_actions_mask = self.valid_actions_mask(obs.observation['available_actions'])
+        valid_actions = np.array(self.executable_actions_ids, dtype=np.int32)[valid_actions_mask]
 
-        available_actions = obs.observation['available_actions']
-        valid_actions = set(available_actions).intersection(self.executable_actions_ids)
-        valid_actions_mask = np.array([True] * len(self.executable_actions_ids))
-        for i in available_actions:
-            if i in valid_actions:
-                valid_actions_mask[self.executable_actions_ids.index(i)] = False
-        non_spatial_action = non_spatial_action.flatten()
-        action_id = self.executable_actions_ids[np.argmax(np.ma.array(non_spatial_action, mask=valid_actions_mask))]
+        # the predictor stacks the inputs into its batch before it returns, so the row can't change in the meantime
+        state = self.store_state(obs.observation, valid_actions_mask, i)
+        non_spatial_action, spatial_action, value = A3CAgent.predictor.predict(state)
+        # the invalid actions get a score of -inf, so they are never selected
+        self.action_scores.fill(-np.inf)
+        np.copyto(self.action_scores, non_spatial_action[0], where=valid_actions_mask)
+        action_id = self.executable_actions_ids[int(np.argmax(self.action_scores))]
 
         action_target = np.argmax(spatial_action.ravel())
         action_target = (action_target // A3C_SCREEN_SIZE_Y, action_target % A3C_SCREEN_SIZE_X)
@@ -286,40 +515,39 @@ class A3CAgent:
             # exploration is done via a combination of epsilon greedy and and adaptive exploration rate
             explore = (A3CAgent.STEP_COUNTER + ((1 - self.exploration_rate) * MAX_STEPS_TOTAL)) / MAX_STEPS_TOTAL
 
-            if np.random.rand() > explore or np.random.rand() < self.epsilon:
-                valid_actions = np.array(list(valid_actions), dtype=np.int32)
-                action_id = np.random.choice(valid_actions)
+            rands = self.rng.random(4)
+
+            if rands[0] > explore or rands[1] < self.epsilon:
+                action_id = self.rng.choice(valid_actions)
                 random_action = True
 
-            if np.random.rand() > explore or np.random.rand() < self.epsilon:
-                action_target = (np.random.randint(0, A3C_SCREEN_SIZE_Y - 1), np.random.randint(0, A3C_SCREEN_SIZE_X - 1))
+            if rands[2] > explore or rands[3] < self.epsilon:
+                action_target = tuple(self.rng.integers(0, [A3C_SCREEN_SIZE_Y - 1, A3C_SCREEN_SIZE_X - 1]))
                 random_position = True
 
         collected_minerals = obs.observation['score_cumulative'][7]
         collected_vespene = obs.observation['score_cumulative'][8]
 
-        self.replay_states.append((nn_input[self.nn.screen],
-                                   nn_input[self.nn.non_spatial_features],
-                                   obs.reward,
-                                   collected_minerals,
-                                   collected_vespene,
-                                   obs.last()))
-        self.replay_actions.append((action_id, action_target, list(valid_actions), random_action, random_position))
-
-        arguments = []
-        for arg in actions.FUNCTIONS[action_id].args:
-            # if the action needs a target, note that select_rect is not supported yet, so only those two are checked
-            if arg.name in ('screen'):
-                arguments.append(action_target)
-            else:
-                arguments.append([0]) # only executing direct actions, no queuing
+        self.replay_rewards[i] = obs.reward
+        self.replay_values[i] = value[0]
+        self.replay_minerals[i] = collected_minerals
+        self.replay_gas[i] = collected_vespene
+        self.replay_last[i] = obs.last()
+        self.replay_action_ids[i] = action_id
+        self.replay_action_targets[i] = action_target
+        self.replay_valid_actions[i] = valid_actions_mask
+        self.replay_random_actions[i] = random_action
+        self.replay_random_positions[i] = random_position
+        self.num_replay_states += 1
+
+        arguments = [action_target if arg is None else arg for arg in self.arg_templates[action_id]]
 
         with A3CAgent.LOCK:
             A3CAgent.STEP_COUNTER += 1
 
         return actions.FunctionCall(action_id, arguments)
 
-    def update(self):
+    def update(self, write_histograms=False):
         """Updating the weights of the neural network.
 
         This method updates the weights of the neural network, it is the implementation of the A3C algorithm. It puts
@@ -331,70 +559,43 @@ class A3CAgent:
         The learning rate for the updates is decreasing over time, the earlier, the higher the learning rate.
         The return values are for saving the progress of the update.
 
+        :param write_histograms: whether to also write the histograms of the weights and gradients to the summary
         :return: total reward of that episode, loss of actor, loss of critic
         """
         with A3CAgent.LOCK:
             global_step_counter = A3CAgent.STEP_COUNTER
             learning_rate = LEARNING_RATE * (1 - 0.9 * A3CAgent.STEP_COUNTER / MAX_STEPS_TOTAL)
 
-        last_state_is_terminal = self.replay_states[-1][-1]
+        rows = self.replay_rows()
+        last_row = (self.num_replay_states - 1) % MAX_EPISODE_STEPS
+        last_state_is_terminal = self.replay_last[last_row]
         if last_state_is_terminal:
             # if the last state in the buffer is a terminal state, set R=0
             R = 0
         else:
-            # else we bootstrap from last step using the value given by the NN
-            screen_states, non_spatial_feature_states = self.replay_states[-1][:2]
-            feed_dict = {self.nn.screen: screen_states,
-                         self.nn.non_spatial_features: non_spatial_feature_states}
-            R = self.tf_session.run(self.nn.value, feed_dict=feed_dict)[0]
-
-        cumulated_rewards = np.zeros(shape=len(self.replay_states,), dtype=np.float32)
-        undiscounted_rewards = np.zeros(shape=len(self.replay_states,), dtype=np.float32)
-        cumulated_rewards[0] = R
-        undiscounted_rewards[0] = R
-
-        # Initialize np arrays for values. These arrays are filled using replay buffer
-        has_spatial_action = np.zeros(shape=(len(self.replay_states,)), dtype=np.float32)
-        spatial_action_selected = np.zeros(shape=(len(self.replay_states), A3C_SCREEN_SIZE_X * A3C_SCREEN_SIZE_Y), dtype=np.float32)
-        valid_non_spatial_action = np.zeros([len(self.replay_states), len(self.executable_actions_ids, )], dtype=np.float32)
-        non_spatial_action_selected = np.zeros([len(self.replay_states), len(self.executable_actions_ids)], dtype=np.float32)
-
-        self.replay_states.reverse()
-        self.replay_actions.reverse()
+            # else we bootstrap from last step using the value given by the NN, it was already computed in step()
+            R = self.replay_values[last_row]
 
-        screen_states = []
-        non_spatial_feature_states = []
-
-        for i in range(len(self.replay_states)):
-            scr, info, reward = self.replay_states[i][:3]
-            screen_states.append(scr)
-            non_spatial_feature_states.append(info)  # These are the info vectors
-
-            if i > 0:
-                cumulated_rewards[i] = reward + self.discount_factor * cumulated_rewards[i-1]
-                undiscounted_rewards[i] = reward
-
-            action_id, action_target, valid_actions = self.replay_actions[i][:3]
-            valid_actions_indices = [0] * len(self.executable_actions_ids)
-            for j in valid_actions:
-                valid_actions_indices[self.executable_actions_ids.index(j)] = 1
+        # the rewards are accumulated from the last state to the first one, all arrays are in the order of the states,
+        # contiguous and of the same type as the inputs of the graph, so they don't have to be converted when fed
+        undiscounted_rewards = self.replay_rewards[rows][::-1].copy()
+        undiscounted_rewards[0] = R
+        cumulated_rewards = np.ascontiguousarray(lfilter([1], [1, -self.discount_factor], undiscounted_rewards)[::-1], dtype=np.float32)
 
-            valid_non_spatial_action[i] = valid_actions_indices
+        # the selected actions are uploaded as indices, the graph turns them into one-hot vectors
+        action_ids = self.replay_action_ids[rows]
+        non_spatial_action = self.action_idx[action_ids]
 
-            non_spatial_action_selected[i, self.executable_actions_ids.index(action_id)] = 1
+        action_targets = self.replay_action_targets[rows]
+        spatial_action = np.where(self.has_screen_arg[action_ids], action_targets[:, 1] * A3C_SCREEN_SIZE_Y + action_targets[:, 0], -1).astype(np.int32)
 
-            args = actions.FUNCTIONS[action_id].args
-            for arg in args:
-                if arg.name in ('screen'):
-                    has_spatial_action[i] = 1
-                    index = action_target[1] * A3C_SCREEN_SIZE_Y + action_target[0]
-                    spatial_action_selected[i, index] = 1
+        valid_non_spatial_action = self.replay_valid_actions[rows]
 
         total_rewards = undiscounted_rewards.sum()
 
-        # MANNSI: Magically reshapes these lists of np arrays into proper np arrays. Also removes one extra dim in the way
-        screen_states = np.array(screen_states).squeeze(axis=1)
-        non_spatial_feature_states = np.array(non_spatial_feature_states).squeeze(axis=1)
+        unit_type_states = self.replay_unit_types[rows]
+        screen_states = self.replay_screens[rows]
+        non_spatial_feature_states = self.replay_non_spatial_features[rows]
 
         # Shuffle all inputs before splitting them into batches
         # Shuffle the arrays
@@ -402,74 +603,93 @@ class A3CAgent:
         # screen_states = screen_states[p]
         # non_spatial_feature_states = non_spatial_feature_states[p]
         # cumulated_rewards = cumulated_rewards[p]
-        # has_spatial_action = has_spatial_action[p]
-        # spatial_action_selected = spatial_action_selected[p]
+        # spatial_action = spatial_action[p]
         # valid_non_spatial_action = valid_non_spatial_action[p]
-        # non_spatial_action_selected = non_spatial_action_selected[p]
-
-        # split the input into batches, to not consume all the GPU memory
-        # MANNSI: These stop being proper np arrays and become lists
-        screen_states = np.array_split(screen_states, NUM_BATCHES)
-        non_spatial_feature_states = np.array_split(non_spatial_feature_states, NUM_BATCHES)
-        cumulated_rewards = np.array_split(cumulated_rewards, NUM_BATCHES)
-        has_spatial_action = np.array_split(has_spatial_action, NUM_BATCHES)
-        spatial_action_selected = np.array_split(spatial_action_selected, NUM_BATCHES)
-        valid_non_spatial_action = np.array_split(valid_non_spatial_action, NUM_BATCHES)
-        non_spatial_action_selected = np.array_split(non_spatial_action_selected, NUM_BATCHES)
+        # non_spatial_action = non_spatial_action[p]
+
+        # copy the whole rollout to the device once, it is split into batches there, to not consume all the GPU memory
+        feed_dict = {self.rollout['unit_type']: unit_type_states,
+                     self.rollout['screen']: screen_states,
+                     self.rollout['non_spatial_features']: non_spatial_feature_states,
+                     self.rollout['R']: cumulated_rewards,
+                     self.rollout['spatial_action']: spatial_action,
+                     self.rollout['valid_non_spatial_actions']: valid_non_spatial_action,
+                     self.rollout['non_spatial_action']: non_spatial_action}
+        self.tf_session.run(self.upload_rollout, feed_dict=feed_dict)
 
         run_options = tf.RunOptions(report_tensor_allocations_upon_oom=True)
 
         losses = np.array([], dtype=np.float32).reshape(0, 2)
 
         for i in range(NUM_BATCHES):
-            feed_dict = {self.nn.screen: screen_states[i],
-                         self.nn.non_spatial_features: non_spatial_feature_states[i],
-                         self.R: cumulated_rewards[i],
-                         self.has_spatial_action: has_spatial_action[i],
-                         self.spatial_action_selected: spatial_action_selected[i],
-                         self.valid_non_spatial_actions: valid_non_spatial_action[i],
-                         self.non_spatial_action_selected: non_spatial_action_selected[i],
-                         self.learning_rate: learning_rate}
-            _, summary, policy_loss, value_loss = self.tf_session.run([self.train, self.summary_op, self.policy_loss, self.value_loss], feed_dict=feed_dict, options=run_options)
-            self.summary_writer.add_summary(summary, global_step_counter)
+            _, policy_loss, value_loss = self.train_step(i, learning_rate, options=run_options)
 
             losses = np.vstack((losses, (policy_loss, value_loss)))
 
-        # reverse it again, so it is in the original order, both lists are used later on
-        self.replay_states.reverse()
-        self.replay_actions.reverse()
+        # the summaries are only written once per update, using the last batch, the histograms are expensive to
+        # compute, therefore they are only written if requested
+        summary_ops = [self.summary_op_scalar]
+        if write_histograms:
+            summary_ops.append(self.summary_op_hist)
+        feed_dict = {self.batch_index: NUM_BATCHES - 1,
+                     self.learning_rate: learning_rate}
+        for summary in self.tf_session.run(summary_ops, feed_dict=feed_dict):
+            self.summary_writer.add_summary(summary, global_step_counter)
 
         avg_losses = losses.mean(axis=0)
         return total_rewards, avg_losses[0], avg_losses[1]
 
-    def create_feed_dict(self, observation):
-        """Creates a feed dictionary for TensorFlow.
+    def replay_rows(self):
+        """Returns the rows of the replay buffers with the states of the current episode, in the order of the states.
+
+        The replay buffers are ring buffers, if an episode has more than MAX_EPISODE_STEPS states only the most recent
+        ones are kept.
+
+        :return: a slice of the rows if the buffers haven't been filled yet, otherwise an array with the rows
+        """
+        if self.num_replay_states <= MAX_EPISODE_STEPS:
+            return slice(0, self.num_replay_states)
+        return (self.num_replay_states + np.arange(MAX_EPISODE_STEPS)) % MAX_EPISODE_STEPS
+
+    def valid_actions_mask(self, available_actions):
+        """Creates a mask of the executable actions which are currently available.
+
+        :param available_actions: the ids of all currently available actions
+        :return: a boolean array which is True for the executable actions that are available
+        """
+        available_actions = np.asarray(available_actions)
+        # actions with a higher id than all executable actions are never executable
+        valid_idx = self.action_idx[available_actions[available_actions < len(self.action_idx)]]
+
+        mask = np.zeros(len(self.executable_actions_ids), dtype=bool)
+        mask[valid_idx[valid_idx >= 0]] = True
+        return mask
+
+    def store_state(self, observation, valid_actions_mask, row):
+        """Stores the inputs of the neural network for an observation in the replay buffers.
 
         This method gets called from step() and takes an observation as input, it reshapes and reduces some of the input
-         data in the way how it is needed for the agent and creates a dictionary that can be fed into TensorFlow.
+         data in the way how it is needed for the agent and writes it directly into a row of the replay buffers. The
+         rows are also the inputs of the forward pass, so the state is neither collected in a dictionary nor copied.
 
         :param observation: all current observations from the environment
-        :return: a dictionary that can be fed into TensorFlow
+        :param valid_actions_mask: the mask of the executable actions which are currently available
+        :param row: the row of the replay buffers for this state
+        :return: the inputs of the neural network for this state (without the batch dimension), in the order of the
+            inputs of the neural network
         """
-        screen = np.array(observation['screen'], dtype=np.float32)
-
-        for i, scale in self.screen_features_layers:
-            screen[i, :, :] = screen[i, :, :] / scale
+        self.replay_unit_types[row] = observation['screen'][self.unit_type_layer]
 
+        # the scaling of the layers is done in the graph, the layers used here have values below 256
         inds = [x[0] for x in self.screen_features_layers]
-        screen = screen[inds, :, :]
-        screen = np.expand_dims(screen, axis=0) # MANNSI: Adds an extra first dimension. NN expects inputs like that
-
-        non_spatial_features = np.array([
-            observation['player'][self.player_feature_indexes],
-        ], dtype=np.float32)
+        # pysc2 returns the layers first, the NN expects them last (NHWC)
+        self.replay_screens[row] = np.moveaxis(observation['screen'][inds], 0, -1)
 
-        non_spatial_features = np.append(non_spatial_features, [1 if i in observation['available_actions'] else 0 for i in self.executable_actions_ids])
-        non_spatial_features = np.expand_dims(non_spatial_features, axis=0)
+        num_player_features = len(self.player_feature_indexes)
+        self.replay_non_spatial_features[row, :num_player_features] = observation['player'][self.player_feature_indexes]
+        self.replay_non_spatial_features[row, num_player_features:] = valid_actions_mask
 
-        feed_dict = {self.nn.screen: screen,
-                     self.nn.non_spatial_features: non_spatial_features}
-        return feed_dict
+        return [self.replay_unit_types[row], self.replay_screens[row], self.replay_non_spatial_features[row]]
 
     def save_checkpoint(self, global_steps, global_episodes):
         """Saves a checkpoint.
@@ -488,21 +708,29 @@ class A3CAgent:
 
         with open(SAVE_PATH + 'python_vars.pickle', 'wb') as f:
             pickle.dump((global_steps, global_episodes, A3C_SCREEN_SIZE_Y, A3C_SCREEN_SIZE_X), f)
-        self.saver.save(self.tf_session, SAVE_PATH + 'SC2_A3C_harvester.ckpt')
+        A3CAgent.saver.save(self.tf_session, SAVE_PATH + 'SC2_A3C_harvester.ckpt')
 
         for k, v in action_logs.items():
-            filename = LOG_PATH + 'agent{:02d}.xml'.format(k)
-            with open(filename, 'w') as f:
-                reparsed = minidom.parseString(ET.tostring(v.getroot()))
-                reparsed.writexml(f, addindent='  ', newl='\n')
+            pending = A3CAgent.pending_action_logs[k]
+            for episode in list(pending):
+                # the agent instance may have dropped the episode in the meantime
+                log_entry = pending.pop(episode, None)
+                if log_entry is not None:
+                    append_actions(*log_entry)
+
+            filename = f'{LOG_PATH}agent{k:02d}.xml'
+            indent_xml(v.getroot())
+            v.write(filename, encoding='utf-8', xml_declaration=True)
 
     def load_checkpoint(self):
         """Restores a checkpoint.
 
-        This method loads and restores a previous run of the agent: the weights of the neural network(using TensorFlow's
-        saver class), as well as some metadata (saved in Python variables) and the log files for each agent instance (as
-        XML). It also performs some checks whether the specifications of the restored agent match with the current agent.
-        It gets called from the start_a3c_agent() function in main.
+        This method loads and restores a previous run of the agent instance: some metadata (saved in Python variables)
+        and the log files of the agent instance (the episode logs as JSON lines and the action logs as XML). The weights
+        of the neural network are shared by all agent instances, they are restored once with restore_weights(). Episodes
+        which were logged after the checkpoint was saved are removed from the episode log, since they will be played
+        again. It also performs some checks whether the specifications of the restored agent match with the current
+        agent. It gets called from the start_a3c_agent() function in main.
 
         :return: whether the restoring of the agent instance was successful
         """
@@ -521,25 +749,71 @@ class A3CAgent:
 
         loaded_successfully = True
         try:
-            A3CAgent.action_logs[self.agent_id] = ET.parse(LOG_PATH + 'agent{:02d}.xml'.format(self.agent_id))
-            root = A3CAgent.action_logs[self.agent_id].getroot()
-            self.episodes = int(root.getchildren()[-1].attrib['num_agent'])
+            with open(f'{LOG_PATH}agent{self.agent_id:02d}.jsonl') as f:
+                episode_logs = [json.loads(line) for line in f]
+            A3CAgent.action_logs[self.agent_id] = ET.parse(f'{LOG_PATH}agent{self.agent_id:02d}.xml')
         except FileNotFoundError:
-            print('Could not find XML file for agent {:d}'.format(self.agent_id))
+            print(f'Could not find log files for agent {self.agent_id:d}')
             loaded_successfully = False
+        else:
+            root = A3CAgent.action_logs[self.agent_id].getroot()
+            self.episode_elements = {int(t.attrib['num_agent']): t for t in root}
+
+            episode_logs = [t for t in episode_logs if t['num_global'] <= A3CAgent.EPISODE_COUNTER]
+            self.episode_log = open(f'{LOG_PATH}agent{self.agent_id:02d}.jsonl', 'w')
+            for t in episode_logs:
+                self.episode_log.write(json.dumps(t) + '\n')
+                self.episodes = t['num_agent']
+                # the XML file is only written with a checkpoint, only the episodes in it can keep their detailed logs
+                if t['num_agent'] in self.episode_elements:
+                    self.kept_episodes = self.track_episode(t['num_agent'], t['total_collected_minerals'], t['total_collected_gas'])
+            self.episode_log.flush()
+
+            for e in list(self.episode_elements):
+                if e not in self.kept_episodes:
+                    root.remove(self.episode_elements.pop(e))
 
+        return loaded_successfully
+
+    def restore_weights(self):
+        """Restores the weights of the neural network from the last checkpoint.
+
+        The weights are shared by all agent instances, so this only has to be called for one of them. It gets called from
+        the start_a3c_agent() function in main, after the variables were initialised.
+        """
         checkpoint = tf.train.get_checkpoint_state(SAVE_PATH)
-        self.saver.restore(self.tf_session, checkpoint.model_checkpoint_path)
+        A3CAgent.saver.restore(self.tf_session, checkpoint.model_checkpoint_path)
 
-        return loaded_successfully
+    def track_episode(self, episode, minerals, gas):
+        """Keeps track of the episodes for which the detailed action logs are kept.
+
+        The DETAILED_LOGS best episodes for collected minerals and for collected gas are kept in two min-heaps, so
+        adding an episode doesn't require looking at all previous episodes. The DETAILED_LOGS most recent episodes are
+        kept as well.
+
+        :param episode: the number of the episode of this agent instance
+        :param minerals: the minerals collected in that episode
+        :param gas: the gas collected in that episode
+        :return: the set of episodes for which the detailed action logs are kept
+        """
+        for top_episodes, value in ((self.top_minerals, minerals), (self.top_gas, gas)):
+            if len(top_episodes) < DETAILED_LOGS:
+                heapq.heappush(top_episodes, (value, episode))
+            else:
+                heapq.heappushpop(top_episodes, (value, episode))
+        self.recent_episodes.append(episode)
+
+        return {e for _, e in self.top_minerals} | {e for _, e in self.top_gas} | set(self.recent_episodes)
 
     def save_action_log(self, num_episode, reward, policy_loss, value_loss):
-        """Saves the logs of all agent instances to a XML.
+        """Saves the logs of an agent instance.
 
-        This method creates a XML log, if it doesn't exist already, otherwise it will append the results for the currently
-        finished episode to XML log. In order to keep the file size reasonable it only stores the detailed action logs
-        of the top 10 episodes for reward, collected minerals and collected gas as well as for the last 10 episodes.
-        It gets called from reset() after every episode.
+        The results of every episode are appended as one JSON line to the episode log of the agent instance. In order to
+        keep the file size reasonable the detailed action logs are only kept for the top 10 episodes for collected
+        minerals and collected gas as well as for the last 10 episodes, in a XML tree, which is written to a file when
+        a checkpoint is saved. The actions of an episode are stored as arrays until then, so only the actions of the
+        episodes that are still kept at that point are turned into XML elements. It gets called from reset() after every
+        episode.
 
         :param num_episode: current total number of episodes
         :param reward: reward for current episode
@@ -552,54 +826,48 @@ class A3CAgent:
         else:
             tree = A3CAgent.action_logs[self.agent_id]
 
-        total_collected_minerals = int(self.replay_states[-1][4])
-        total_collected_gas = int(self.replay_states[-1][5])
-
-        minerals_per_episode = [(self.episodes, total_collected_minerals)]
-        gas_per_episode = [(self.episodes , total_collected_gas)]
-        for t in tree.findall('episode'):
-            value = int(t.attrib['total_collected_minerals'])
-            episode = int(t.attrib['num_agent'])
-            minerals_per_episode.append((episode, value))
-
-            value = int(t.attrib['total_collected_gas'])
-            episode = int(t.attrib['num_agent'])
-            gas_per_episode.append((episode, value))
-
-        # keep detailed logs only for the 5 best results for minerals and gas
-        # add all episodes to the list, sort them and prune the list
-        minerals_per_episode.sort(key=lambda tup: tup[1], reverse=True)
-        gas_per_episode.sort(key=lambda tup: tup[1], reverse=True)
-        kept_episodes = set([i[0] for i in minerals_per_episode[:DETAILED_LOGS] + gas_per_episode[:DETAILED_LOGS]] + [j for j in range(self.episodes - DETAILED_LOGS + 1, self.episodes + 1)])
-        other_episodes = set([i[0] for i in minerals_per_episode + gas_per_episode]) - kept_episodes
-
-        log_entry = ET.SubElement(tree.getroot(), 'episode')
-        log_entry.attrib['num_global'] = str(num_episode)
-        log_entry.attrib['num_agent'] = str(self.episodes)
-        log_entry.attrib['total_collected_minerals'] = str(total_collected_minerals)
-        log_entry.attrib['total_collected_gas'] = str(total_collected_gas)
-        log_entry.attrib['loss_actor'] = str(policy_loss)
-        log_entry.attrib['loss_critic'] = str(value_loss)
-        log_entry.attrib['reward'] = str(reward)
+        if self.episode_log is None:
+            if not os.path.exists(LOG_PATH):
+                os.makedirs(LOG_PATH)
+            self.episode_log = open(f'{LOG_PATH}agent{self.agent_id:02d}.jsonl', 'w')
+
+        episode_log = {
+            'num_global': num_episode,
+            'num_agent': self.episodes,
+            'total_collected_minerals': int(self.replay_minerals[(self.num_replay_states - 1) % MAX_EPISODE_STEPS]),
+            'total_collected_gas': int(self.replay_gas[(self.num_replay_states - 1) % MAX_EPISODE_STEPS]),
+            'loss_actor': float(policy_loss),
+            'loss_critic': float(value_loss),
+            'reward': float(reward),
+        }
+        self.episode_log.write(json.dumps(episode_log) + '\n')
+        self.episode_log.flush()
+
+        # keep detailed logs only for the best results for minerals and gas as well as for the most recent episodes
+        kept_episodes = self.track_episode(self.episodes, episode_log['total_collected_minerals'], episode_log['total_collected_gas'])
+        other_episodes = self.kept_episodes - kept_episodes
+        self.kept_episodes = kept_episodes
 
         if self.episodes in kept_episodes:
-            for i, action in enumerate(self.replay_actions):
-                performed_action = ET.SubElement(log_entry, 'action')
-                performed_action.attrib['name'] = actions.FUNCTIONS[action[0]].name
-                performed_action.attrib['x'] = str(action[1][0])
-                performed_action.attrib['y'] = str(action[1][1])
-                performed_action.attrib['random_action'] = str(action[3])
-                performed_action.attrib['random_position'] = str(action[4])
-
-                collected_minerals = self.replay_states[i][4]
-                collected_gas = self.replay_states[i][5]
-
-                performed_action.attrib['collected_minerals'] = str(int(collected_minerals))
-                performed_action.attrib['collected_gas'] = str(int(collected_gas))
+            log_entry = ET.SubElement(tree.getroot(), 'episode')
+            for k, v in episode_log.items():
+                log_entry.attrib[k] = str(v)
+
+            rows = self.replay_rows()
+            columns = {
+                'name': self.replay_action_ids[rows].copy(),
+                'x': self.replay_action_targets[rows, 0].copy(),
+                'y': self.replay_action_targets[rows, 1].copy(),
+                'random_action': self.replay_random_actions[rows].copy(),
+                'random_position': self.replay_random_positions[rows].copy(),
+                'collected_minerals': self.replay_minerals[rows].copy(),
+                'collected_gas': self.replay_gas[rows].copy(),
+            }
+            A3CAgent.pending_action_logs[self.agent_id][self.episodes] = (log_entry, columns)
+            self.episode_elements[self.episodes] = log_entry
 
         for e in other_episodes:
-            remove_entry = tree.find('.//episode[@num_agent="{:d}"]'.format(e))
-            for r in remove_entry.findall('action'):
-                remove_entry.remove(r)
+            A3CAgent.pending_action_logs[self.agent_id].pop(e, None)
+            tree.getroot().remove(self.episode_elements.pop(e))
 
         A3CAgent.action_logs[self.agent_id] = tree
@@ -1,5 +1,6 @@
 import os
 import glob
+import json
 import pickle
 import numpy as np
 import matplotlib.pyplot as plt
@@ -9,32 +10,44 @@ from a3c_agent import LOG_PATH, SAVE_PATH, PLOT_PATH, CHECKPOINT
 
 """Script for analysing agent's actions.
 
-This script reads all XML log files and plots figures and histograms for the rewards, collected minerals and collected
- gas. It finds the best 10 episodes in terms of those three factors and computes statistics about the performed actions. 
+This script reads all episode logs (JSON lines) and plots figures and histograms for the rewards, collected minerals and
+collected gas. It reads the detailed action logs from the XML log files. It finds the best 10 episodes in terms of those
+three factors and computes statistics about the performed actions.
 """
 
 
+def read_jsonl(filename):
+    """Reads an episode log.
+
+    This function reads a given episode log, which has one JSON object per line, and returns a list of all global
+    episode numbers, rewards, minerals and gas of the episodes.
+
+    :param filename: the name of the episode log to read
+    :return: a list of all global episode numbers, rewards, minerals and gas in that episode log
+    """
+    results = []
+    with open(filename) as f:
+        for line in f:
+            episode = json.loads(line)
+            results.append((episode['num_global'], episode['reward'], episode['total_collected_minerals'],
+                            episode['total_collected_gas']))
+
+    return results
+
+
 def read_xml(filename):
     """Reads and parses and XML file.
 
-    This function reads and parses a given XML file and returns a list of all global episode numbers, rewards, gas and
-    XML tags (including actions, if available) of the episodes.
+    This function reads and parses a given XML action log and returns the XML tags of the episodes (including their
+    actions).
 
     :param filename: the name of the XML file to read
-    :return: a list of all global episode numbers, rewards, gas and XML tags in that XML file
+    :return: a list of all XML tags of the episodes in that XML file
     """
-    results = []
     xml = ET.parse(filename)
     root = xml.getroot()
 
-    for episode in root.getchildren():
-        num = int(episode.attrib['num_global'])
-        reward = float(episode.attrib['reward'])
-        minerals = int(episode.attrib['total_collected_minerals'])
-        gas = int(episode.attrib['total_collected_gas'])
-        results.append((num, reward, minerals, gas, episode))
-
-    return results
+    return list(root)
 
 
 def averaged_mean(x, N):
@@ -91,10 +104,10 @@ def analyse_actions(episodes):
     episodes_action = 0
 
     for i in episodes:
-        if len(i.getchildren()) > 0:
+        if len(i) > 0:
             episodes_action += 1
 
-        for j in i.getchildren():
+        for j in i:
             random_action = j.attrib['random_action'] == 'True'
             random_postion = j.attrib['random_position'] == 'True'
 
@@ -133,7 +146,8 @@ def analyse_actions(episodes):
 if __name__ == '__main__':
     """Main function, it runs the script.
     
-    It iterates over all XML files in the LOG_PATH and calls all functions above. It also plots the results to PLOT_PATH.
+    It iterates over all episode logs and XML files in the LOG_PATH and calls all functions above. It also plots the
+    results to PLOT_PATH.
     """
     with open(SAVE_PATH + 'python_vars.pickle', 'rb') as f:
         python_vars = pickle.load(f)
@@ -141,13 +155,17 @@ if __name__ == '__main__':
         episode_count = python_vars[1]
 
     results = []
+    for i in glob.glob(LOG_PATH + '*.jsonl'):
+        results += read_jsonl(i)
+
+    results_xml = []
     for i in glob.glob(LOG_PATH + '*.xml'):
-        results += read_xml(i)
+        results_xml += read_xml(i)
 
     results.sort(key=lambda l:l[0])
     results = results[:episode_count] # clipping number of episodes to number from pickle file
-    results_array = np.array(list(zip(*results))[:4]).transpose()
-    results_xml = list(zip(*results))[-1]
+    results_array = np.array(results)
+    results_xml = [i for i in results_xml if int(i.attrib['num_global']) <= episode_count]
 
     result_dict = {}
     episodes = results_array[:, 0]
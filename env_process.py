@@ -0,0 +1,136 @@
+"""Environments that run in their own processes.
+
+This module doesn't import TensorFlow or the agent, the environment processes import it (and the main module) and should
+only load what they need for running the game.
+"""
+
+import sys
+import multiprocessing
+from absl import flags
+from pysc2.env import sc2_env
+
+# the environment processes are not forked from the main process, which has TensorFlow loaded and runs several threads,
+# the forkserver (only available on Unix) or a spawned interpreter imports the main module and this module again
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    MP_CONTEXT = multiprocessing.get_context('forkserver')
+else:
+    MP_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def run_env(pipe, argv, observations, ssize_x, ssize_y, msize_x, msize_y, display=False):
+    """Runs an environment process.
+
+    This helper function creates the environment in its own process, signals that it is ready and executes the method
+    calls it receives over the pipe on it, until it receives a 'close'. The results (or the exception raised by a call)
+    are sent back over the pipe.
+
+    :param pipe: the pipe to the EnvProcess that controls this environment
+    :param argv: the command line arguments of the main process, the environment needs the parsed flags of pysc2
+    :param observations: the names of the observations used by the agent, only these are sent back
+    :param ssize_x: X-size of the screen
+    :param ssize_y: Y-size of the screen
+    :param msize_x: X-size of the minimap
+    :param msize_y: Y-size of the minimap
+    :param display: whether to display the pygame output of an agent, for performance reasons deactivated by default
+    """
+    if not flags.FLAGS.is_parsed():
+        flags.FLAGS(argv, known_only=True)
+
+    with sc2_env.SC2Env(map_name='CollectMineralsAndGas',
+                        agent_race='T',
+                        difficulty=None,
+                        step_mul=8,
+                        game_steps_per_episode=0,
+                        screen_size_px=(ssize_x, ssize_y),
+                        minimap_size_px=(msize_x, msize_y),
+                        visualize=display) as env:
+        pipe.send('ready')
+        while True:
+            method, args = pipe.recv()
+            if method == 'close':
+                break
+            try:
+                result = getattr(env, method)(*args)
+                if method in ('reset', 'step'):
+                    # only the observations used by the agent are sent, the others don't have to be pickled
+                    result = [timestep._replace(observation={k: timestep.observation[k] for k in observations})
+                              for timestep in result]
+                pipe.send(result)
+            except Exception as e:
+                pipe.send(e)
+
+
+class EnvProcess:
+    """Environment that runs in its own process.
+
+    This class starts an environment in a separate process (with run_env()) and has the same interface as the
+    environment, every method call is sent over a pipe to the process. The environment processes run the game and
+    prepare the observations without holding the GIL of the agent threads. The action spec of pysc2 can't be pickled,
+    so it isn't available.
+    """
+
+    def __init__(self, *args):
+        """Starts the environment process.
+
+        :param args: the arguments for run_env() after the pipe and the command line arguments
+        """
+        self.ready = False
+        self.pipe, child_pipe = MP_CONTEXT.Pipe()
+        self.process = MP_CONTEXT.Process(target=run_env, args=(child_pipe, sys.argv) + args, daemon=True)
+        self.process.start()
+        child_pipe.close()
+
+    def wait_until_ready(self, timeout=None):
+        """Waits until the environment was created in its process.
+
+        :param timeout: the maximum number of seconds to wait, None for waiting without a limit
+        :return: whether the environment is ready, False if its process ended without creating it
+        """
+        try:
+            if not self.ready and self.pipe.poll(timeout):
+                self.ready = self.pipe.recv() == 'ready'
+        except (EOFError, OSError):
+            return False
+        return self.ready
+
+    def call(self, method, *args):
+        """Calls a method of the environment in the environment process.
+
+        :param method: the name of the method
+        :param args: the arguments of the method
+        :return: the result of the method
+        """
+        self.wait_until_ready()
+        self.pipe.send((method, args))
+        result = self.pipe.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def observation_spec(self):
+        return self.call('observation_spec')
+
+    def reset(self):
+        return self.call('reset')
+
+    def step(self, actions):
+        return self.call('step', actions)
+
+    def close(self):
+        """Closes the environment and waits until its process has ended.
+
+        A process whose environment isn't ready is terminated, it might never read the message for closing it.
+        """
+        if self.process.is_alive():
+            if self.ready:
+                self.pipe.send(('close', ()))
+            else:
+                self.process.terminate()
+            self.process.join()
+        self.pipe.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
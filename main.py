@@ -1,59 +1,99 @@
 import os
 import threading
 import time
-import tensorflow as tf
+
+# threads a single TensorFlow op may use, also limits the OpenMP/MKL thread pools which have to be set before
+# TensorFlow is imported
+INTRA_OP_THREADS = 2
+os.environ.setdefault('OMP_NUM_THREADS', str(INTRA_OP_THREADS))
+os.environ.setdefault('TF_NUM_INTRAOP_THREADS', str(INTRA_OP_THREADS))
+
 from absl import app
 from absl import flags
-from pysc2.env import run_loop
-from pysc2.env import sc2_env
 
-from a3c_agent import A3CAgent
-from a3c_agent import A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, PARALLEL_THREADS, SAVE_PATH,\
-    LOG_PATH, TRAINING
+from env_process import EnvProcess
 
 
 flags.DEFINE_string("agent", "a3c", "Which agent to run.")
 
+ENV_STARTUP_TIMEOUT = 60  # seconds to wait for an environment, an agent whose environment isn't ready isn't started
+# share of the GPU memory the session may use, all agents share one session, so it only needs to be lowered when other
+# processes use the same GPU
+GPU_MEMORY_FRACTION = 1.0
+
 """Script for starting all agents (a3c, very simple and slightly smarter).
 
 This scripts is the starter for all agents, it has one command line parameter (--agent), that denotes which agent to run.
 By default it runs the A3C agent.
 """
 
-def run_thread(agent, ssize_x, ssize_y, msize_x, msize_y, display=False):
-    """Runs an agent thread.
+class EnvWorker:
+    """Runs an agent in its environment.
 
-    This helper function creates the evironment for an agent and starts the main loop of one thread.
-
-    :param agent: agent to run
-    :param ssize_x: X-size of the screen
-    :param ssize_y: Y-size of the screen
-    :param msize_x: X-size of the minimap
-    :param msize_y: Y-size of the minimap
-    :param display: whether to display the pygame output of an agent, for performance reasons deactivated by default
+    The environment (process) is kept for the whole run. If a step of the environment fails, the episode is ended and
+    the environment is reset, instead of starting a new environment.
     """
-    with sc2_env.SC2Env(map_name='CollectMineralsAndGas',
-                        agent_race='T',
-                        difficulty=None,
-                        step_mul=8,
-                        game_steps_per_episode=0,
-                        screen_size_px=(ssize_x, ssize_y),
-                        minimap_size_px=(msize_x, msize_y),
-                        visualize=display) as env:
 
-        run_loop.run_loop([agent], env)
+    def __init__(self, agent, env):
+        """Initialises the worker.
+
+        :param agent: agent to run
+        :param env: the environment (process) of the agent
+        """
+        self.agent = agent
+        self.env = env
+
+    def run(self):
+        """Main loop of an agent thread, based on pysc2's run_loop.
+
+        The agent selects the actions for the environment until it stops the thread with a KeyboardInterrupt, the
+        environment is closed at the end.
+        """
+        total_frames = 0
+        start_time = time.time()
+
+        with self.env:
+            # the action spec of pysc2 can't be pickled and isn't used by the agent, so it isn't sent by the environment
+            self.agent.setup(self.env.observation_spec(), None)
+            try:
+                while True:
+                    timesteps = self.env.reset()
+                    self.agent.reset()
+                    while True:
+                        total_frames += 1
+                        actions = [self.agent.step(timesteps[0])]
+                        if timesteps[0].last():
+                            break
+                        try:
+                            timesteps = self.env.step(actions)
+                        except Exception as e:
+                            print(f'Environment of agent {self.agent.agent_id:d} failed, resetting it: {e}')
+                            break
+            except KeyboardInterrupt:
+                pass
+            finally:
+                elapsed_time = time.time() - start_time
+                print(f'Took {elapsed_time:.3f} seconds for {total_frames:d} steps: {total_frames / elapsed_time:.3f} fps')
 
 
 def start_a3c_agent():
     """Starts the A3C agent.
 
     Helper function for setting up the A3C agents. If it is in training mode it starts PARALLEL_THREADS agents, otherwise
-    it will only start one agent. It creates the TensorFlow session and TensorFlow's summary writer. If it is continuing
+    it will only start one agent. The environments are started as processes before TensorFlow creates its session and
+    thread pools, the agent threads only select the actions, batched in one forward pass by the agent's predictor. It
+    creates the TensorFlow session and TensorFlow's summary writer. If it is continuing
     a previous session and can't find an agent instance, it will just ignore this instance. It also initialises the
     weights of the neural network, if it doesn't find a previously saved one and initialises it. If it should show the
     pygame output of an agent, it only shows it for the first instance. Most of it's behaviour can be controlled with
     the same constants that can be found in a3c_agent.py and are also used by the A3C agent.
     """
+    # the environment processes import this module as well, so TensorFlow and the agent are only imported here
+    import tensorflow as tf
+    from a3c_agent import A3CAgent
+    from a3c_agent import A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, PARALLEL_THREADS, SAVE_PATH, LOG_PATH, TRAINING,\
+        OBSERVATIONS
+
     summary_writer = tf.summary.FileWriter(LOG_PATH)
 
     if not TRAINING:
@@ -69,24 +109,42 @@ def start_a3c_agent():
     #    run_thread(agent, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, A3C_MINIMAP_SIZE_X, A3C_MINIMAP_SIZE_Y, False)
     # return
 
-    with tf.Session() as session:
-        agents = []
-        for i in range(parallel):
-            agent = A3CAgent(session, i, summary_writer)
-            if os.path.exists(SAVE_PATH):
-                if agent.load_checkpoint():
-                    agents.append(agent)
-            else:
-                agents.append(agent)
-
-        session.run(tf.global_variables_initializer())  # This used to be in the agent initialize method.
+    envs = [EnvProcess(OBSERVATIONS, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, False)
+            for _ in range(parallel)]
+
+    # all agent threads and the predictor share one session, so every op only gets a few threads and the agents can run
+    # their ops side by side
+    config = tf.ConfigProto(intra_op_parallelism_threads=INTRA_OP_THREADS,
+                            inter_op_parallelism_threads=parallel,
+                            allow_soft_placement=True)
+    config.gpu_options.allow_growth = True
+    config.gpu_options.per_process_gpu_memory_fraction = GPU_MEMORY_FRACTION
+    # XLA compiles the small layers of the network (and their gradients) into a few fused kernels
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+    with tf.Session(config=config) as session:
+        agents = [A3CAgent(session, i, summary_writer) for i in range(parallel)]
+        A3CAgent.saver = tf.train.Saver()
+
+        # the variables are initialised before a checkpoint is restored, otherwise the restored weights are overwritten
+        session.run([tf.global_variables_initializer(), tf.local_variables_initializer()])  # This used to be in the agent initialize method.
+        if os.path.exists(SAVE_PATH):
+            agents[0].restore_weights()
+            agents = [agent for agent in agents if agent.load_checkpoint()]
         threads = []
-        for agent in agents:
-            thread_args = (agent, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, A3C_SCREEN_SIZE_X, A3C_SCREEN_SIZE_Y, False)
-            t = threading.Thread(target=run_thread, args=thread_args)
+        for agent, env in zip(agents, envs):
+            # the environments start up in parallel, an agent starts as soon as its environment is ready
+            if not env.wait_until_ready(timeout=ENV_STARTUP_TIMEOUT):
+                print(f'Environment for agent {agent.agent_id:d} is not ready after {ENV_STARTUP_TIMEOUT:d} seconds, '
+                      f'the agent is not started')
+                env.close()
+                continue
+            t = threading.Thread(target=EnvWorker(agent, env).run)
             threads.append(t)
             t.start()
-            time.sleep(5)
+        # environments of agents without a checkpoint are not needed
+        for env in envs[len(agents):]:
+            env.close()
         for t in threads:
             t.join()
 